@@ -25,7 +25,7 @@ def main(
 ):
     # If xticklabels or yticklabels are not provided, generate them based on xs and ys
     if xticklabels is None:
-        xticklabels = np.vectorize(lambda s: chr(s + ord('A')))(np.arange(xs))
+        xticklabels = (np.arange(xs, dtype=np.uint32) + ord('A')).view('U1')
     if yticklabels is None:
         yticklabels = np.arange(ys)
 
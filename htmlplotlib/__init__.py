@@ -7,7 +7,7 @@ is to generate HTML output, providing flexibility for web integration and use in
 
 Modules:
 - color_ranges: Contains predefined color ranges for various color maps.
-- gradient: Provides functions to generate linear gradients between colors.
+- gradient: Provides functions to generate linear gradients between colors (as hex strings or RGB arrays).
 - html_heatmap: Main module for generating heatmaps and color bars in HTML format.
 
 Main Features:
@@ -24,7 +24,7 @@ Usage Example:
     data = np.random.rand(16, 16)
     html = htmlplotlib.html_heatmap(
         data,
-        xticklabels=np.vectorize(lambda s: chr(s + ord('A')))(np.arange(16)),
+        xticklabels=(np.arange(16, dtype=np.uint32) + ord('A')).view('U1'),
         yticklabels=np.arange(16),
         fmt='.2f',
         cmap='coolwarm',
@@ -47,7 +47,7 @@ Version: 0.2.3
 """
 
 from .color_ranges import COLOR_RANGES
-from .gradient import linear_gradient
+from .gradient import linear_gradient, linear_gradient_rgb
 from .html_heatmap import html_heatmap
 
 __version__ = "0.2.3"
@@ -0,0 +1,44 @@
+"""Optional Numba kernels; used only when numba is installed and importable.
+
+numba is imported on first use rather than at package import, so plain
+``import htmlplotlib`` stays cheap. If that import fails (e.g. numba built
+against a different NumPy), `_HAS_NUMBA` is cleared and callers fall back
+to NumPy; they also fall back for any call the kernel can't compile.
+"""
+
+import importlib.util
+from functools import lru_cache
+
+_HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+@lru_cache(maxsize=None)
+def _color_idx_kernel():
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def kernel(data, vmin, scale, ncm1, out):
+        for i in numba.prange(data.shape[0]):
+            for j in range(data.shape[1]):
+                # clamp as float before int(): huge or infinite values would overflow
+                x = (data[i, j] - vmin) * scale
+                if not x > 0:  # also catches NaN
+                    x = 0
+                elif x > ncm1:
+                    x = ncm1
+                out[i, j] = int(x)
+        return out
+
+    return kernel
+
+def compute_color_idx(data, vmin, scale, ncm1, out):
+    """Fills `out` with palette indices, or returns None if numba can't handle the call."""
+    global _HAS_NUMBA
+    try:
+        kernel = _color_idx_kernel()
+    except ImportError:
+        _HAS_NUMBA = False
+        return None
+    try:
+        return kernel(data, vmin, scale, ncm1, out)
+    except Exception:  # typing/compile failure for these argument types
+        return None
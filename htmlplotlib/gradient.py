@@ -1,16 +1,21 @@
 import numpy as np
 
+_HEX2 = [f'{i:02x}' for i in range(256)]
+
+def rgb_to_hex(rgb: np.ndarray) -> list:
+    """Formats an `(n, 3)` uint8 RGB array as '#rrggbb' strings."""
+    return ['#' + _HEX2[r] + _HEX2[g] + _HEX2[b] for r, g, b in rgb.tolist()]
+
+def linear_gradient_rgb(colors: list, n: int) -> np.ndarray:
+    """Generates a linear gradient of `n` colors as an `(n, 3)` uint8 RGB array."""
+    palette = np.frombuffer(bytes.fromhex(''.join(c[1:7] for c in colors)), dtype=np.uint8).reshape(-1, 3)
+    palette = palette.astype(np.float64)
+    idx = np.linspace(0, len(colors) - 1, n)
+    lower = np.floor(idx).astype(np.intp)
+    upper = np.ceil(idx).astype(np.intp)
+    mix = (idx - lower)[:, None]
+    return np.rint((1 - mix) * palette[lower] + mix * palette[upper]).astype(np.uint8)
+
 def linear_gradient(colors: list, n: int) -> list:
     """Generates a linear gradient of `n` colors between the provided colors."""
-    gradient = []
-    for i in range(n):
-        idx = i * (len(colors) - 1) / (n - 1)
-        lower, upper = int(np.floor(idx)), int(np.ceil(idx))
-        mix = idx - lower
-        lower_color = np.array([int(colors[lower][j:j + 2], 16) for j in (1, 3, 5)])
-        upper_color = np.array([int(colors[upper][j:j + 2], 16) for j in (1, 3, 5)])
-        mixed_color = np.round((1 - mix) * lower_color + mix * upper_color).astype(int)
-        hex_color = ''.join(f'{c:02x}' for c in mixed_color)
-        gradient.append(f'#{hex_color}')
-    return gradient
-
+    return rgb_to_hex(linear_gradient_rgb(colors, n))
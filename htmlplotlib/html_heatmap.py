@@ -1,156 +1,320 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
 import numpy as np
-from typing import Union, List, Optional, Set
+from functools import lru_cache
+from typing import Union, List, Optional, Set, Tuple
 from .color_ranges import COLOR_RANGES
-from .gradient import linear_gradient
-from collections import namedtuple
+from .gradient import linear_gradient_rgb, rgb_to_hex
+from . import _kernels
 
-DataTuple = namedtuple('DataTuple', ['original', 'normalized'])
+_YTICK_TH = '<th style="padding: 5px; text-align: center; background-color: #f0f0f0;">%s</th>'
+_CBAR_LABEL_H = ('<span style="position: absolute; left: %s%%; top: 50%%; transform: translate(-%s%%, -50%%); '
+                 'font-size: 10px; color: %s;">%s</span>')
+_CBAR_LABEL_V = ('<span style="position: absolute; top: %s%%; left: 50%%; transform: translate(-50%%, -%s%%); '
+                 'font-size: 10px; color: %s;">%s</span>')
 
+@lru_cache(maxsize=512)
 def text_color_for_background(bg_color: str) -> str:
-    rgb = np.array([int(bg_color[i:i + 2], 16) for i in (1, 3, 5)])
-    brightness = np.mean(rgb) / 255  # Simplified brightness check
-    return '#FFFFFF' if brightness < 0.5 else '#000000'
+    v = int(bg_color[1:7], 16)
+    r, g, b = v >> 16, (v >> 8) & 0xFF, v & 0xFF
+    return '#FFFFFF' if r + g + b < 382.5 else '#000000'  # mean brightness below 0.5
+
+def text_colors_for_colormap(colors) -> List[str]:
+    """Vectorized `text_color_for_background` over a whole list of '#rrggbb' colors."""
+    rgb = np.frombuffer(bytes.fromhex(''.join(c[1:7] for c in colors)), dtype=np.uint8).reshape(-1, 3)
+    return _text_colors_for_rgb(rgb)
+
+def _text_colors_for_rgb(rgb: np.ndarray) -> List[str]:
+    return np.where(rgb.sum(axis=1) < 382.5, '#FFFFFF', '#000000').tolist()
 
 def calculate_nice_range(data_min: float, data_max: float) -> (float, float):
+    data_min, data_max = float(data_min), float(data_max)  # narrow/unsigned ints would wrap
     range_span = data_max - data_min
-    magnitude = 10 ** np.floor(np.log10(range_span))
+    if range_span == 0:
+        return data_min - 1, data_max + 1
+    magnitude = 10 ** np.floor(np.log10(max(abs(range_span), np.finfo(float).tiny)))
     nice_min = np.floor(data_min / magnitude) * magnitude
     nice_max = np.ceil(data_max / magnitude) * magnitude
     return nice_min, nice_max
 
-def get_cmap(cmap_name: str, n: int = 256) -> List[str]:
+@lru_cache(maxsize=64)
+def get_cmap_rgb(cmap_name: str, n: int = 256) -> np.ndarray:
     if cmap_name in COLOR_RANGES:
-        return linear_gradient(COLOR_RANGES[cmap_name], n)
+        rgb = linear_gradient_rgb(COLOR_RANGES[cmap_name], n)
+        rgb.flags.writeable = False  # shared by every caller through the cache
+        return rgb
     raise ValueError(f"Color map '{cmap_name}' is not available in custom maps.")
 
-def generate_grid_html(data_with_norm, colors, annot, fmt, linewidths, linecolor, square,
-                       xticklabels, yticklabels, scale_factor, font_size):
-    rows_html = ''
-    xtick_html = ''
+@lru_cache(maxsize=64)
+def get_cmap(cmap_name: str, n: int = 256) -> Tuple[str, ...]:
+    return tuple(rgb_to_hex(get_cmap_rgb(cmap_name, n)))
+
+@lru_cache(maxsize=64)
+def get_cmap_with_text(cmap_name: str, n: int = 256) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    return get_cmap(cmap_name, n), tuple(_text_colors_for_rgb(get_cmap_rgb(cmap_name, n)))
+
+# Below this many cells NumPy is already sub-millisecond and numba's first-call
+# import/compile cost (0.3-1 s) can't pay off.
+_NUMBA_MIN_CELLS = 1_000_000
+
+def compute_color_idx(data, vmin: float, vmax: float, ncm1: int) -> np.ndarray:
+    """Maps each value of `data` to an index into a palette of `ncm1 + 1` colors."""
+    # float32 input stays float32; anything else is computed in float64
+    ftype = np.float32 if data.dtype == np.float32 else np.float64
+    span = ftype(vmax - vmin) or ftype(1.0)  # a zero-width range would divide by zero
+    scale = ftype(ncm1 / span)
+    # the kernel only compiles for native-order float32/float64 and integer input
+    if (_kernels._HAS_NUMBA and data.ndim == 2 and data.size >= _NUMBA_MIN_CELLS and data.dtype.isnative
+            and (data.dtype in (np.float32, np.float64) or data.dtype.kind in 'iu')):
+        out = np.empty(data.shape, dtype=np.intp)
+        color_idx = _kernels.compute_color_idx(np.ascontiguousarray(data), ftype(vmin), scale, ncm1, out)
+        if color_idx is not None:
+            return color_idx
+    # one temporary, updated in place
+    scaled = np.subtract(data, ftype(vmin), dtype=ftype)
+    scaled *= scale
+    # clip before the cast: huge or infinite values would overflow intp.
+    # fmax/fmin rather than clip so NaN (e.g. under mask=np.isnan(data)) becomes 0, not an invalid cast.
+    np.fmax(scaled, 0, out=scaled)
+    np.fmin(scaled, ncm1, out=scaled)
+    return scaled.astype(np.intp)
+
+def format_values(data, fmt: str) -> List[List[str]]:
+    """Formats every value of a 2-D array with `fmt`, converting to Python scalars once."""
+    return [[format(val, fmt) for val in row] for row in np.asarray(data).tolist()]
+
+@lru_cache(maxsize=32)
+def _build_xtick_html(xticklabels: Tuple[str, ...], has_y: bool) -> str:
+    return ''.join([
+        '<tr>',
+        '<th style="background-color: #f0f0f0;"></th>' if has_y else '',
+        *(f'<th style="text-align: center; padding: 5px; background-color: #f0f0f0;">{label}</th>'
+          for label in xticklabels),
+        '</tr>',
+    ])
+
+@lru_cache(maxsize=8)
+def _td_open_tags(n: int) -> Tuple[str, ...]:
+    # index n is the masked-cell sentinel: no color class
+    return tuple(f'<td class="c{k}">' for k in range(n)) + ('<td>',)
+
+@lru_cache(maxsize=8)
+def _td_empty_cells(n: int) -> Tuple[str, ...]:
+    return tuple(tag + '</td>' for tag in _td_open_tags(n))
+
+def write_grid_html(out, color_idx, annots, colors, text_colors, linewidths, linecolor, square,
+                    xticklabels, yticklabels, scale_factor, font_size):
+    """Writes the heatmap table to `out` one row at a time.
+
+    Only the HTML is streamed: `color_idx` and `annots` (from `compute_color_idx` and
+    `format_values`, or None for no annotations) already hold the whole grid.
+    """
+    cell_px = scale_factor * 50
+
+    # Shared cell styling goes in one <style> block; each cell only carries its color class.
+    # Rules are only emitted for colors that appear (index len(colors) is the mask sentinel).
+    used = np.zeros(len(colors) + 1, dtype=bool)
+    used[color_idx.ravel()] = True
+    rules = [
+        f'{{border-collapse: collapse; font-size: {font_size}px; margin: 0;}}',
+        f' td{{border: {linewidths}px solid {linecolor}; text-align: center; '
+        f'width: {cell_px}px; height: {cell_px}px;}}',
+    ]
+    rules.extend([' .c%d{background-color: %s; color: %s;}' % (k, colors[k], text_colors[k])
+                  for k in np.flatnonzero(used[:-1]).tolist()])
+    # Named after the styling itself, so the same input always gives the same HTML and
+    # tables from separate runs on one page can only share a class if their rules agree.
+    table_class = 'hm' + hashlib.blake2b(''.join(rules).encode(), digest_size=8).hexdigest()
+    out.write('<style>' + ''.join(['.' + table_class + rule for rule in rules]))
+    out.write(f'</style><table class="{table_class}">')
     if xticklabels is not None:
-        xtick_html = (
-            '<tr>' +
-            ('<th style="background-color: #f0f0f0;"></th>' if yticklabels is not None else '') +
-            ''.join(
-                f'<th style="text-align: center; padding: 5px; background-color: #f0f0f0;">{label}</th>'
-                for label in xticklabels
-            ) +
-            '</tr>'
-        )
-
-    for i, row in enumerate(data_with_norm):
-        y_label = (
-            f'<th style="padding: 5px; text-align: center; background-color: #f0f0f0;">{yticklabels[i]}</th>'
-            if yticklabels is not None else ''
-        )
-        row_html = y_label + ''.join(
-            (
-                f'<td style="background-color: {colors[int(val.normalized * (len(colors) - 1))]}; '
-                f'border: {linewidths}px solid {linecolor}; text-align: center; '
-                f'width: {scale_factor * 50}px; height: {scale_factor * 50}px; '
-                f'color: {text_color_for_background(colors[int(val.normalized * (len(colors) - 1))])};">'
-                f'{f"{val.original:{fmt}}" if annot else ""}</td>'
-            )
-            for val in row
-        )
-        rows_html += f'<tr>{row_html}</tr>'
-
-    table_html = (
-        f'<table style="border-collapse: collapse; font-size: {font_size}px; margin: 0;">'
-        f'{xtick_html}{rows_html}</table>'
-    )
+        out.write(_build_xtick_html(tuple(map(str, xticklabels)), yticklabels is not None))
+
+    num_rows = color_idx.shape[0]
+    if yticklabels is not None:
+        row_heads = ['<tr>' + _YTICK_TH % (yticklabels[i],) for i in range(num_rows)]
+    else:
+        row_heads = ['<tr>'] * num_rows
+    idx_rows = color_idx.tolist()  # plain ints: no numpy scalar per cell
+    write = out.write
+    # annot=False gets its own loop so empty cells are single cached strings
+    if annots is None:
+        td_empty = _td_empty_cells(len(colors))
+        for i in range(num_rows):
+            row_parts = [row_heads[i]]
+            row_parts.extend([td_empty[k] for k in idx_rows[i]])
+            row_parts.append('</tr>')
+            write(''.join(row_parts))
+    else:
+        td_open = _td_open_tags(len(colors))
+        for i in range(num_rows):
+            row_parts = [row_heads[i]]
+            row_parts.extend([td_open[k] + text + '</td>' for k, text in zip(idx_rows[i], annots[i])])
+            row_parts.append('</tr>')
+            write(''.join(row_parts))
 
-    return table_html
+    out.write('</table>')
+
+def generate_grid_html(color_idx, annots, colors, text_colors, linewidths, linecolor, square,
+                       xticklabels, yticklabels, scale_factor, font_size) -> str:
+    out = io.StringIO()
+    write_grid_html(out, color_idx, annots, colors, text_colors, linewidths, linecolor, square,
+                    xticklabels, yticklabels, scale_factor, font_size)
+    return out.getvalue()
 
 def generate_color_bar_html(cmap_name, colors, width='100%', height='20px',
                             orientation='horizontal', debug=None, vmin=0, vmax=1,
-                            cbar_fmt='.1f', num_labels=5):
+                            cbar_fmt='.1f', num_labels=5, text_colors=None):
+    if text_colors is None:
+        text_colors = text_colors_for_colormap(colors)
+    return _color_bar_html(tuple(colors), tuple(text_colors), width, height, orientation,
+                           vmin, vmax, cbar_fmt, num_labels)
+
+@lru_cache(maxsize=64)
+def _color_bar_html(colors, text_colors, width, height, orientation, vmin, vmax, cbar_fmt, num_labels):
+    ncm1 = len(colors) - 1
     gradient_direction = "to right" if orientation == 'horizontal' else "to top"
-    label_positions = np.linspace(vmin, vmax, num_labels)
-    label_texts = [f'{tick:{cbar_fmt}}' for tick in label_positions]
+    label_texts = [format(tick, cbar_fmt) for tick in np.linspace(vmin, vmax, num_labels).tolist()]
 
-    color_bar_html = (
+    label_template = _CBAR_LABEL_H if orientation == 'horizontal' else _CBAR_LABEL_V
+    positions = np.linspace(0, 100, num_labels)
+    offsets = positions if orientation == 'horizontal' else 100 - positions
+    label_idx = (positions / 100 * ncm1).astype(np.intp)
+    parts = [
         f'<div style="position: relative; width: {width}; height: {height}; margin-top: 20px; margin-left: 40px;">'
         f'<div style="width: 100%; height: 100%; background: linear-gradient({gradient_direction}, {", ".join(colors)});"></div>'
-    )
-
-    for i, (pos, text) in enumerate(zip(np.linspace(0, 100, num_labels), label_texts)):
-        bg_color = colors[int(pos / 100 * (len(colors) - 1))]
-        text_color = text_color_for_background(bg_color)
-
-        if orientation == 'horizontal':
-            label_style = f'left: {pos}%; top: 50%; transform: translate(-{pos}%, -50%);'
-        else:
-            label_style = f'top: {100 - pos}%; left: 50%; transform: translate(-50%, -{100 - pos}%);'
+    ]
+    parts.extend([
+        label_template % (offset, offset, text_colors[k], text)
+        for k, offset, text in zip(label_idx.tolist(), offsets.tolist(), label_texts)
+    ])
+    parts.append('</div>')
 
-        color_bar_html += (
-            f'<span style="position: absolute; {label_style}; font-size: 10px; color: {text_color};">{text}</span>'
-        )
+    return ''.join(parts)
 
-    color_bar_html += '</div>'
+_HTML_CACHE_SIZE = 16
+_HTML_CACHE_MAX_PAGE = 1 << 20  # larger pages are not kept; bounds the cache at ~16M chars
+_html_cache = OrderedDict()
+_html_cache_lock = threading.Lock()
 
-    return color_bar_html
+def _html_cache_key(data, *args):
+    """Key for a rendered heatmap, or None when the inputs can't be hashed cheaply."""
+    if data.dtype.hasobject:
+        return None
+    # Scalars are keyed with their type: 1 == 1.0 == True, but they render differently.
+    try:
+        args = tuple(tuple(map(str, a)) if isinstance(a, (list, tuple, np.ndarray, range)) else (type(a), a)
+                     for a in args)
+        key = (hashlib.blake2b(np.ascontiguousarray(data), digest_size=16).digest(),
+               data.dtype.str, data.shape) + args
+        hash(key)
+    except TypeError:  # unhashable arguments, 0-d arrays, ...
+        return None
+    return key
 
 def html_heatmap(data, xticklabels=None, yticklabels=None, annot=True, fmt='.2f',
                  cmap='viridis', vmin=None, vmax=None, square=False,
                  linewidths=1, linecolor='white', mask=None,
                  xlabel='', ylabel='', show=False, font_size=10, scale_factor=1.0,
-                 cbar_kws=None, cbar_fmt='.1f', debug=False):
+                 cbar_kws=None, cbar_fmt='.1f', debug=False, out=None):
+
+    data = np.asarray(data)
+
+    # Streamed, masked and debug renders are not cached.
+    cache_key = None
+    if out is None and mask is None and not debug:
+        cache_key = _html_cache_key(data, xticklabels, yticklabels, annot, fmt, cmap, vmin, vmax, square,
+                                    linewidths, linecolor, xlabel, ylabel, font_size, scale_factor,
+                                    tuple(sorted(cbar_kws.items())) if cbar_kws else None, cbar_fmt)
+
+    full_html = None
+    if cache_key is not None:
+        with _html_cache_lock:
+            full_html = _html_cache.get(cache_key)
+            if full_html is not None:
+                _html_cache.move_to_end(cache_key)
+    if full_html is None:
+        # Stream straight into `out` unless the HTML is also needed as a string.
+        writer = out if out is not None and not show else io.StringIO()
+        _write_heatmap_html(writer, data, xticklabels, yticklabels, annot, fmt, cmap, vmin, vmax, square,
+                            linewidths, linecolor, mask, xlabel, ylabel, font_size, scale_factor,
+                            cbar_kws, cbar_fmt, debug)
+        if writer is out:
+            return None
+        full_html = writer.getvalue()
+        if cache_key is not None and len(full_html) <= _HTML_CACHE_MAX_PAGE:
+            with _html_cache_lock:
+                _html_cache[cache_key] = full_html
+                if len(_html_cache) > _HTML_CACHE_SIZE:
+                    _html_cache.popitem(last=False)
+
+    if out is not None:
+        out.write(full_html)
+
+    if show:
+        from IPython.display import display, HTML
+        display(HTML(full_html))
+    elif out is None:
+        return full_html
+
+def _write_heatmap_html(writer, data, xticklabels, yticklabels, annot, fmt, cmap, vmin, vmax, square,
+                        linewidths, linecolor, mask, xlabel, ylabel, font_size, scale_factor,
+                        cbar_kws, cbar_fmt, debug):
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
 
     if vmin is None or vmax is None:
-        data_min, data_max = calculate_nice_range(np.min(data), np.max(data))
+        visible = data if mask is None or mask.all() else data[~mask]
+        data_min, data_max = calculate_nice_range(np.min(visible), np.max(visible))
         vmin = vmin if vmin is not None else data_min
         vmax = vmax if vmax is not None else data_max
     else:
         vmin, vmax = calculate_nice_range(vmin, vmax)
 
-    data_plus = [[DataTuple(val, (val - vmin) / (vmax - vmin)) for val in row] for row in data]
+    colors, text_colors = get_cmap_with_text(cmap)
 
-    colors = get_cmap(cmap)
+    color_idx = compute_color_idx(data, vmin, vmax, len(colors) - 1)
 
-    orientation = cbar_kws.get('orientation', 'horizontal') if cbar_kws else 'horizontal'
+    if mask is None:
+        annots = format_values(data, fmt) if annot else None
+    else:
+        color_idx[mask] = len(colors)
+        annots = None
+        if annot:
+            # only visible cells are formatted; masked ones stay blank
+            annots = np.full(data.shape, '', dtype=object)
+            annots[~mask] = [format(val, fmt) for val in data[~mask].tolist()]
+            annots = annots.tolist()
 
-    grid_html = generate_grid_html(data_plus, colors, annot, fmt, linewidths, linecolor,
-                                   square, xticklabels, yticklabels, scale_factor, font_size)
+    orientation = cbar_kws.get('orientation', 'horizontal') if cbar_kws else 'horizontal'
 
-    color_bar_size = f"{scale_factor * 50 * data.shape[1]}px" if orientation == 'horizontal' else f"{scale_factor * 50 * data.shape[0]}px"
+    cell_px = scale_factor * 50
+    color_bar_size = f"{cell_px * data.shape[1]}px" if orientation == 'horizontal' else f"{cell_px * data.shape[0]}px"
     color_bar_html = generate_color_bar_html(cmap, colors,
                                              width=color_bar_size if orientation == 'horizontal' else '20px',
                                              height='20px' if orientation == 'horizontal' else color_bar_size,
-                                             orientation=orientation, debug=debug, vmin=vmin, vmax=vmax, cbar_fmt=cbar_fmt)
+                                             orientation=orientation, debug=debug, vmin=vmin, vmax=vmax, cbar_fmt=cbar_fmt,
+                                             text_colors=text_colors)
 
     xlabel_html = f'<div style="text-align: center; font-weight: bold; margin-bottom: 10px;">{xlabel}</div>' if xlabel else ''
 
     ylabel_html = (
         f'<div style="writing-mode: vertical-rl; transform: rotate(180deg); text-align: center; '
-        f'font-weight: bold; margin-right: 10px; height: {scale_factor * 50 * data.shape[0]}px;">{ylabel}</div>'
+        f'font-weight: bold; margin-right: 10px; height: {cell_px * data.shape[0]}px;">{ylabel}</div>'
         if ylabel else ''
     )
 
     if orientation == 'horizontal':
-        full_html = (
-            f'<div style="display: flex; align-items: center; justify-content: center; flex-direction: column;">'
-            f'{xlabel_html}'
-            f'<div style="display: flex; align-items: center; justify-content: center;">'
-            f'{ylabel_html}'
-            f'{grid_html}'
-            f'</div>'
-            f'{color_bar_html}'
-            f'</div>'
-        )
-    else:
-        full_html = (
-            f'{xlabel_html}'
-            f'<div style="display: flex; align-items: center; justify-content: center;">'
-            f'{ylabel_html}'
-            f'{grid_html}'
-            f'{color_bar_html}'
-            f'</div>'
-        )
-
-    if show:
-        from IPython.display import display, HTML
-        display(HTML(full_html))
-    else:
-        return full_html
+        writer.write('<div style="display: flex; align-items: center; justify-content: center; flex-direction: column;">')
+    writer.write(xlabel_html)
+    writer.write('<div style="display: flex; align-items: center; justify-content: center;">')
+    writer.write(ylabel_html)
+    write_grid_html(writer, color_idx, annots, colors, text_colors, linewidths, linecolor,
+                    square, xticklabels, yticklabels, scale_factor, font_size)
+    if orientation == 'horizontal':
+        writer.write('</div>')
+    writer.write(color_bar_html)
+    writer.write('</div>')
 